@@ -19,13 +19,22 @@ Licence:
 - Rendered scores = CC0 (Public Domain). Mark Gotham and FourScoreAndMore.org waive all rights to those documents.
 """
 
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import csv
 from music21 import converter, stream, metadata, expressions
+from music21.musicxml import helpers, m21ToXml
+import numpy as np
 import pandas as pd
 from pathlib import Path
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import multiprocessing
+import re
+from xml.etree.ElementTree import Element, SubElement
+import zipfile
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Logging (configured when run as a script, see below)
 logger = logging.getLogger(__name__)
 
 # Constants
@@ -33,6 +42,12 @@ REPO = Path(__file__).parent.resolve()
 
 # Data extraction configuration
 SEARCH_HEADERS = ["Fig. ", "Species: ", "Modal final: ", "Cantus firmus: "]
+# One pattern for the whole annotation, e.g. "Fig. 5; Species: 1; Modal final: d; Cantus firmus: Lower".
+# Components are separated by "; " and so cannot contain it.
+ANNOTATION_PATTERN = re.compile(
+    "; ".join(re.escape(header) + "((?:(?!; ).)*)" for header in SEARCH_HEADERS),
+    re.DOTALL
+)
 WRITE_HEADERS = ["Figure", "Species", "Modal final", "Cantus firmus"]
 COLUMN_NAMES = ["Measure start"] + WRITE_HEADERS
 
@@ -44,6 +59,25 @@ SCORE_COMPOSER = "Fux, Johann Joseph"
 BASE_RAW_GIT = "https://raw.githubusercontent.com/MarkGotham/species/refs/heads/main/1x1/"
 BASE_VHV_URL = "https://verovio.humdrum.org/?file=" + BASE_RAW_GIT
 
+# MusicXML attributes to carry over to the start of each segment, and the order they appear in
+CARRIED_ATTRIBUTES = {"divisions", "key", "time", "staves", "clef", "transpose"}
+ATTRIBUTES_ORDER = [
+    "footnote", "level", "divisions", "key", "time", "staves", "part-symbol", "instruments",
+    "clef", "staff-details", "transpose", "for-part", "directive", "measure-style"
+]
+
+# Container file for compressed MusicXML (.mxl)
+MXL_CONTAINER = """<?xml version="1.0" encoding="UTF-8"?>
+<container>
+  <rootfiles>
+    <rootfile full-path="{xml_name}"/>
+  </rootfiles>
+</container>
+"""
+
+# Buffer size for writing output files (large enough to hold a whole html table)
+WRITE_BUFFER_SIZE = 1 << 20
+
 # HTML template
 HTML_TEMPLATE = """<!DOCTYPE html>
 <html>
@@ -78,6 +112,7 @@ HTML_TEMPLATE = """<!DOCTYPE html>
 </body>
 </html>
 """
+HTML_PREFIX, HTML_SUFFIX = HTML_TEMPLATE.format(table_html="{table_html}").split("{table_html}")
 
 
 def process_all(input_path: Path = REPO) -> None:
@@ -87,13 +122,54 @@ def process_all(input_path: Path = REPO) -> None:
     :param input_path: Top level of the repo.
     :return: None (writes files to disk)
     """
-    for part in ["I", "II", "III"]:
-        section_file = input_path / part / f"{part}-Solutions.mxl"
+    section_files = [input_path / part / f"{part}-Solutions.mxl" for part in ["I", "II", "III"]]
+
+    # Sections are independent and parsing is CPU-bound, so process them in parallel.
+    # Workers send their log records back here, to be handled as configured in this process.
+    log_queue = multiprocessing.Queue()
+    log_listener = QueueListener(log_queue, RelayLogHandler())
+    with ProcessPoolExecutor(
+            max_workers=len(section_files),
+            initializer=init_worker_logging,
+            initargs=(log_queue, logger.getEffectiveLevel())
+    ) as executor:
+        futures = [executor.submit(process_section_file, section_file) for section_file in section_files]
+        # Only start the listener thread now that the workers exist: forking a multi-threaded process is unsafe.
+        # Records sent in the meantime wait in the queue.
+        log_listener.start()
         try:
-            process_section_file(section_file)
-            logger.info(f"Successfully processed {section_file}")
-        except Exception as e:
-            logger.error(f"Failed to process {section_file}: {e}")
+            for section_file, future in zip(section_files, futures):
+                try:
+                    future.result()
+                    logger.info("Successfully processed %s", section_file)
+                except Exception as e:
+                    logger.error("Failed to process %s: %s", section_file, e)
+        finally:
+            executor.shutdown()  # Workers flush their queued log records on exit
+            log_listener.stop()
+
+
+class RelayLogHandler(logging.Handler):
+    """
+    Handle log records relayed from worker processes
+    with the logger of the same name in this process (and so its handlers, or those of its ancestors).
+    """
+
+    def emit(self, record: logging.LogRecord) -> None:
+        logging.getLogger(record.name).handle(record)
+
+
+def init_worker_logging(log_queue: multiprocessing.Queue, level: int) -> None:
+    """
+    Send this module's log records from a worker process to the parent process, via a queue.
+    The worker's root logger is left alone.
+
+    :param log_queue: Queue read by a `QueueListener` in the parent process
+    :param level: Effective level of this module's logger in the parent process
+    """
+    logger.setLevel(level)
+    logger.addHandler(QueueHandler(log_queue))
+    logger.propagate = False  # Forked workers inherit the parent's root handlers: avoid logging twice
 
 
 def process_section_file(
@@ -116,6 +192,7 @@ def process_section_file(
     if not input_path.is_relative_to(REPO):
         raise ValueError(f"Input path {input_path} must be relative to repository {REPO}")
 
+    # music21 keeps (and checks the freshness of) its own pickled copy of each parse, reused on repeat calls
     score = converter.parse(input_path)
 
     # Extract data from score annotations
@@ -127,82 +204,90 @@ def process_section_file(
     if output_dir is None:
         output_dir = input_path.parent
 
+    # Extract figure numbers (without any comment text), shared by the html links and the segment file names
+    figure_names = zfill_figures(dataframe["Figure"])
+
     if write_data:
         write_tsv(dataframe, output_dir)
 
     if html_table:
-        write_html_table(dataframe, output_dir)
+        write_html_table(dataframe, output_dir, figure_names)
 
     if create_segments:
-        write_score_segments(score, dataframe)
+        write_score_segments(
+            score,
+            dataframe["Measure start"].to_numpy(),
+            dataframe["Measure end"].to_numpy(),
+            figure_names.to_numpy(),
+        )
 
 
-def extract_figure_data(score: stream.Score) -> list:
+def extract_figure_data(score: stream.Score) -> dict:
     """
     Extract figure metadata from text expressions in the score.
 
     :param score: music21 Score object
-    :return: List of data rows, each containing the same data (measure_number, figure number ...)
+    :return: Dict mapping each of COLUMN_NAMES to a list of values (measure_number, figure number ...)
     """
-    text_expressions = score.recurse().getElementsByClass(expressions.TextExpression)
-    data = []
-
-    for text_expr in text_expressions:
-        measure_number = text_expr.getContextByClass(stream.Measure).number
-        text_components = text_expr.content.split("; ")
-
-        if len(text_components) != len(SEARCH_HEADERS):
-            raise ValueError(
-                f"Expected {len(SEARCH_HEADERS)} components in text expression at measure {measure_number}, "
-                f"got {len(text_components)}. "
-                f"Raw content: {text_expr.content}"
-            )
-
-        entry = [measure_number]
-
-        for index, header in enumerate(SEARCH_HEADERS):
-            if not text_components[index].startswith(header):
-                raise ValueError(
-                    f"At measure {measure_number}, "
-                    f"expected component at index {index} to start with '{header}', "
-                    f"got '{text_components[index]}'."
-                )
-            entry.append(text_components[index][len(header):])
-
-        data.append(entry)
+    data = {column: [] for column in COLUMN_NAMES}
+    measure_starts = data["Measure start"]
+    text_columns = [data[header] for header in WRITE_HEADERS]
+    annotation_match = ANNOTATION_PATTERN.fullmatch
+
+    # Single descent through parts and measures, keeping the current measure number to hand
+    # rather than looking up the enclosing measure of each text expression.
+    for part in score.parts:
+        for measure in part.getElementsByClass(stream.Measure):
+            measure_number = measure.number
+            for text_expr in measure.recurse().getElementsByClass(expressions.TextExpression):
+                match = annotation_match(text_expr.content)
+
+                if match is None:
+                    raise ValueError(
+                        f"At measure {measure_number}, "
+                        f"expected text expression with components {SEARCH_HEADERS} separated by '; ', "
+                        f"got '{text_expr.content}'."
+                    )
+
+                measure_starts.append(measure_number)
+                for column, value in zip(text_columns, match.groups()):
+                    column.append(value)
 
     return data
 
 
-def create_dataframe_with_ranges(data: list, score) -> pd.DataFrame:
+def create_dataframe_with_ranges(data: dict, score) -> pd.DataFrame:
     """
     Create a DataFrame with measure start/end ranges and counts.
 
-    :param data: Extracted figure data
+    :param data: Extracted figure data, by column
     :param score: music21 Score object for measure validation
     :return: DataFrame with columns including Measure start, Measure end, and Measure Count
     """
-    dataframe = pd.DataFrame(data, columns=COLUMN_NAMES)
-
-    # Calculate measure end positions (one before the next figure starts)
-    dataframe["Measure end"] = dataframe["Measure start"].shift(-1).fillna(0).astype('int64')
-    dataframe["Measure end"] = dataframe["Measure end"] - 1
-
-    # Set the final measure end to the last measure in the score
-    measure_numbers = [m.measureNumber for m in score.parts[0].getElementsByClass(stream.Measure)]
-
-    # Validate that measure numbering is sequential
-    expected_measures = list(range(1, len(measure_numbers) + 1))
-    if measure_numbers != expected_measures:
-        raise ValueError(
-            f"Measure numbering is not a standard sequential sequence. "
-            f"Expected {expected_measures}, got {measure_numbers}"
-        )
+    dataframe = pd.DataFrame({
+        "Measure start": np.asarray(data["Measure start"], dtype=np.int64),
+        **{header: np.asarray(data[header], dtype=object) for header in WRITE_HEADERS},
+    })
+
+    # Validate that measure numbering is sequential, in one pass.
+    # The final figure runs to the last of these measures.
+    final_measure = 0
+    for measure in score.parts[0].getElementsByClass(stream.Measure):
+        if measure.measureNumber != final_measure + 1:
+            raise ValueError(
+                f"Measure numbering is not a standard sequential sequence. "
+                f"Expected {final_measure + 1} after measure {final_measure}, got {measure.measureNumber}"
+            )
+        final_measure += 1
 
-    dataframe.loc[dataframe.index[-1], "Measure end"] = measure_numbers[-1]
+    # Calculate measure end positions (one before the next figure starts; the last runs to the final measure)
+    # as one int64 array, assigned as a whole column.
+    starts = dataframe["Measure start"].to_numpy()
+    ends = np.concatenate([starts[1:] - 1, np.array([final_measure], dtype=np.int64)])
+    dataframe["Measure end"] = ends
 
     # Calculate measure count for each figure
-    dataframe["Measure Count"] = (dataframe["Measure end"] - dataframe["Measure start"] + 1).astype('int64')
+    dataframe["Measure Count"] = ends - starts + 1
 
     return dataframe
 
@@ -215,83 +300,84 @@ def write_tsv(dataframe: pd.DataFrame, output_dir: Path) -> None:
     :param output_dir: Directory to write to
     """
     output_path = output_dir / "data.tsv"
-    dataframe.to_csv(output_path, sep='\t', index=False)
-    logger.info(f"Wrote data to {output_path}")
+    columns = [dataframe[column].to_numpy() for column in dataframe.columns]
+    with open(output_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(dataframe.columns)
+        writer.writerows(zip(*columns))
+    logger.info("Wrote data to %s", output_path)
 
 
 def write_html_table(
         dataframe: pd.DataFrame,
-        output_dir: Path
+        output_dir: Path,
+        figure_names: pd.Series
 ) -> None:
     """
     Generate HTML with DataTables integration for searchable/sortable display.
 
     :param dataframe: Data to display
     :param output_dir: Directory to write HTML file
+    :param figure_names: File name (without extension) for each figure, as from `zfill_figures`
     """
     output_path = output_dir / "search.html"
 
-    dataframe["Direct download"] = dataframe["Figure"].apply(format_download_links)
-    dataframe["View on VHV"] = dataframe["Figure"].apply(format_vhv_link)
+    # Build the link columns for the whole table at once
+    shared_urls = BASE_RAW_GIT + figure_names
+    dataframe["Direct download"] = (
+        '<a href="' + shared_urls + '.mxl">.mxl</a> <a href="' + shared_urls + '.krn">.krn</a>'
+    )
+    dataframe["View on VHV"] = '<a href="' + BASE_VHV_URL + figure_names + '.krn">click here</a>'
 
-    # Generate table HTML and add required ID
-    table_html = dataframe.to_html(index=False, classes='table table-striped table-hover', border=0, escape=False)
-    table_html = table_html.replace('<table', '<table id="dataframe"', 1)
+    # Write the page row by row rather than building the whole table (and page) as strings.
+    # Cells are converted to text once per column, and the (pre-built) links are written as they are.
+    columns = [dataframe[column].astype(str).to_numpy() for column in dataframe.columns]
+    row_template = "    <tr>\n" + "      <td>{}</td>\n" * len(columns) + "    </tr>\n"
 
-    # Insert table into template
-    html_content = HTML_TEMPLATE.format(table_html=table_html)
+    with open(output_path, 'w', buffering=WRITE_BUFFER_SIZE) as f:
+        f.write(HTML_PREFIX)
+        f.write('<table id="dataframe" class="dataframe table table-striped table-hover">\n')
+        f.write('  <thead>\n    <tr style="text-align: right;">\n')
+        f.writelines(f"      <th>{column}</th>\n" for column in dataframe.columns)
+        f.write("    </tr>\n  </thead>\n  <tbody>\n")
+        f.writelines(row_template.format(*row) for row in zip(*columns))
+        f.write("  </tbody>\n</table>")
+        f.write(HTML_SUFFIX)
 
-    with open(output_path, 'w') as f:
-        f.write(html_content)
+    logger.info("Wrote HTML to %s", output_path)
 
-    logger.info(f"Wrote HTML to {output_path}")
-
-
-def format_download_links(figure: str) -> str:
-    """
-    Create download links for MXL and KRN formats.
 
-    :param figure: Figure name (mostly numeric, though datatype is string)
-    :return: Html string for clickable links.
+def zfill_figures(figures: pd.Series) -> pd.Series:
     """
-    figure_name = zfill_figure(figure)
-    shared_url = f"{BASE_RAW_GIT}{figure_name}"
-    return f'<a href="{shared_url}.mxl">.mxl</a> <a href="{shared_url}.krn">.krn</a>'
-
-
-def format_vhv_link(figure: str) -> str:
-    """
-    Create an HTML-formatter link to Verovio Humdrum Viewer (VHV).
-
-    :param figure: Figure name/number
-    :return: URL string for clickable link to VHV.
-    """
-    figure_name = zfill_figure(figure)
-    return f'<a href="{BASE_VHV_URL}{figure_name}.krn">click here</a>'
-
-
-def zfill_figure(figure_name: str) -> str:
-    """
-    Extract the figure number (without notes) and zfill for the range here (3 digits).
+    Extract the figure numbers (without notes) and zfill for the range here (3 digits).
     Hacky workaround to for cases like 88a.
     At least those anomalies are all in the range 80–90.
+
+    :param figures: Series of figure names (strings, possibly with notes after a space)
+    :return: Series of zfilled figure numbers.
     """
-    figure_name = figure_name.split(" ")[0]
-    if figure_name.startswith("8"):
-        return "0" + figure_name
-    else:
-        return figure_name.zfill(3)
+    figure_names = figures.str.split(" ", n=1).str[0]
+    return figure_names.str.zfill(3).mask(figure_names.str.startswith("8"), "0" + figure_names)
 
 
 def write_score_segments(
         score,
-        dataframe: pd.DataFrame,
+        starts: np.ndarray,
+        ends: np.ndarray,
+        figure_names: np.ndarray,
 ) -> None:
     """
     Create individual score files for each figure segment.
 
+    The whole score is exported to MusicXML once,
+    and each segment is then cut from that tree, rather than re-running the export per figure.
+    Segments are written serially: after the single export, each one takes only milliseconds,
+    so a per-figure process pool (nested inside the section pool of `process_all`) does not pay off.
+
     :param score: music21 Score object
-    :param dataframe: DataFrame with measure ranges
+    :param starts: First measure number of each figure
+    :param ends: Last measure number of each figure
+    :param figure_names: File name (without extension) for each figure, e.g., from `zfill_figures`
     """
     # Configure score metadata
     configure_score_metadata(score)
@@ -300,16 +386,114 @@ def write_score_segments(
     segment_dir = REPO / "1x1"
     segment_dir.mkdir(exist_ok=True)
 
+    # Export once, and index each part's measures for slicing.
+    # Taking all the measures (as for a segment) leaves out the whole-section layout and credits.
+    all_measures = score.measures(0, None, indicesNotNumbers=True)
+    exporter = m21ToXml.ScoreExporter(m21ToXml.GeneralObjectExporter().fromGeneralObject(all_measures))
+    root = exporter.parse()
+    xml_header = exporter.xmlHeader()
+    parts = {id(part): index_part_measures(part) for part in root.iter("part")}
+
     # Write each segment
-    for _, row in dataframe.iterrows():
-        section = score.measures(row["Measure start"], row["Measure end"])
-        # Extract figure number (without any comment text)
+    for start, end, figure_name in zip(starts, ends, figure_names):
+        # Measures are numbered sequentially from 1 (see `create_dataframe_with_ranges`), so slice by index
+        segment_root = Element(root.tag, root.attrib)
+        for child in root:
+            if child.tag == "part":
+                measure_groups, attribute_states = parts[id(child)]
+                segment_part = SubElement(segment_root, "part", child.attrib)
+                for group in measure_groups[start - 1:end]:
+                    segment_part.extend(group)
+                # The first measure needs the attributes (clef, key, etc.) in force at that point
+                first_measure_index = len(measure_groups[start - 1]) - 1
+                segment_part[first_measure_index] = with_attributes(
+                    segment_part[first_measure_index],
+                    attribute_states[start - 1]
+                )
+            else:
+                segment_root.append(child)
+
+        xml_bytes = xml_header + helpers.dumpString(segment_root, noCopy=True).encode("utf-8")
+        write_mxl(xml_bytes, segment_dir / f"{figure_name}.mxl")
 
-        figure_name = zfill_figure(row["Figure"])
-        output_path = segment_dir / figure_name
-        section.write("mxl", output_path)
+    logger.info("Wrote %d score segments to %s", len(figure_names), segment_dir)
 
-    logger.info(f"Wrote {len(dataframe)} score segments to {segment_dir}")
+
+def index_part_measures(part: Element) -> tuple:
+    """
+    Group the children of an exported MusicXML part by measure,
+    and record the attributes in force at the start of each measure.
+
+    :param part: MusicXML <part> element
+    :return: Tuple of two lists, with one entry per measure:
+        the measure's elements (the measure, preceded by any divider comments)
+        and a dict of the attribute elements in force at the start of it.
+    """
+    measure_groups = []
+    attribute_states = []
+    pending = []
+    state = {}
+
+    for child in part:
+        pending.append(child)
+        if child.tag != "measure":
+            continue
+        measure_groups.append(pending)
+        attribute_states.append(dict(state))
+        pending = []
+        for attributes in child.iterfind("attributes"):
+            for attribute in attributes:
+                if attribute.tag in CARRIED_ATTRIBUTES:
+                    state[(attribute.tag, attribute.get("number"))] = attribute
+
+    return measure_groups, attribute_states
+
+
+def with_attributes(measure: Element, state: dict) -> Element:
+    """
+    Return a measure which includes all the attributes in `state` that it does not already set.
+    The original measure is not modified (it may be used by other segments).
+
+    :param measure: MusicXML <measure> element
+    :param state: Attribute elements in force before the measure, as returned by `index_part_measures`
+    :return: The measure itself, or a shallow copy with completed attributes.
+    """
+    attributes = measure.find("attributes")
+    present = set() if attributes is None else {(a.tag, a.get("number")) for a in attributes}
+    missing = [attribute for key, attribute in state.items() if key not in present]
+    if not missing:
+        return measure
+
+    measure = copy.copy(measure)
+    if attributes is None:
+        new_attributes = Element("attributes")
+        position = 0
+        while position < len(measure) and measure[position].tag == "print":
+            position += 1
+        measure.insert(position, new_attributes)
+    else:
+        new_attributes = copy.copy(attributes)
+        measure[list(measure).index(attributes)] = new_attributes
+
+    new_attributes[:] = sorted(
+        list(new_attributes) + missing,
+        key=lambda a: ATTRIBUTES_ORDER.index(a.tag) if a.tag in ATTRIBUTES_ORDER else len(ATTRIBUTES_ORDER)
+    )
+    return measure
+
+
+def write_mxl(xml_bytes: bytes, output_path: Path) -> None:
+    """
+    Write MusicXML to a compressed .mxl file, in the same layout as music21.
+
+    :param xml_bytes: Complete MusicXML document
+    :param output_path: Path to the .mxl file to write
+    """
+    xml_name = output_path.with_suffix(".musicxml").name
+    container = MXL_CONTAINER.format(xml_name=xml_name)
+    with zipfile.ZipFile(output_path, "w", compression=zipfile.ZIP_DEFLATED) as mxl:
+        mxl.writestr(xml_name, xml_bytes)
+        mxl.writestr("META-INF/container.xml", container)
 
 
 def configure_score_metadata(score) -> None:
@@ -323,12 +507,16 @@ def configure_score_metadata(score) -> None:
         part.partName = str(i + 1)
         part.partAbbreviation = ""
 
-    # Set score metadata
-    score.insert(0, metadata.Metadata())
-    score.metadata.title = SCORE_TITLE
-    score.metadata.movementName = SCORE_TITLE  # Duplicate for display purposes
-    score.metadata.composer = SCORE_COMPOSER
+    # Set score metadata, keeping any existing entries (e.g., rights)
+    score_metadata = score.metadata
+    if score_metadata is None:
+        score_metadata = metadata.Metadata()
+        score.insert(0, score_metadata)
+    score_metadata.title = SCORE_TITLE
+    score_metadata.movementName = SCORE_TITLE  # Duplicate for display purposes
+    score_metadata.composer = SCORE_COMPOSER
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     process_all()
\ No newline at end of file